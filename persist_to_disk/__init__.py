@@ -5,6 +5,8 @@ import os
 from typing import Any, Callable, List, Optional, Tuple, Union
 
 from . import persister
+from ._lazy import LazyValue
+from ._serializers import register_serializer
 from .config import Config
 from .persister import (
     CACHE,
@@ -13,6 +15,7 @@ from .persister import (
     READONLY,
     RECACHE,
     Persister,
+    WriteBatch,
     persist_func_version,
 )
 
@@ -32,6 +35,12 @@ def persistf(
     hash_method="pickle",
     local: bool = False,
     alt_dirs: List[str] = None,
+    adaptive: bool = False,
+    dedup: bool = False,
+    lazy: bool = False,
+    serializer: str = "auto",
+    lock_timeout: float = None,
+    lock_wait: str = None,
 ):
     """Base decorator that does all the heavy-lifting for caching, taking additional arguments.
 
@@ -67,6 +76,29 @@ def persistf(
             Whether to use local cache. Defaults to False.
         alt_dirs (List[str], optional):
             Alternative directories to *read* the cache. Defaults to None.
+        adaptive (bool, optional):
+            Measure the compute time and the read time of the cache, and keep the results
+            in memory only (or not at all) if reading is slower than computing.
+            See `f.adaptive_report()` for the decisions. Defaults to False.
+        dedup (bool, optional):
+            Write identical results only once (under their content hash),
+            with the buckets only holding references. Defaults to False.
+        lazy (bool, optional):
+            Return a `LazyValue` handle, which only reads and deserializes the cached value on
+            first access (`.get()` or any attribute access). Defaults to False.
+        serializer (str, optional):
+            How to serialize the results: 'auto' picks a serializer by the type of the result
+            (e.g. raw buffers for NumPy arrays, Arrow for DataFrames), falling back to pickle.
+            Can also be the name of any serializer (see `register_serializer`).
+            Defaults to 'auto'.
+        lock_timeout (float, optional):
+            Seconds to wait for a lock before raising `Timeout` (negative to wait forever).
+            Defaults to what's set in config (300).
+        lock_wait (str, optional):
+            How to wait for a lock: 'block' (OS-level blocking wait, forever regardless of *lock_timeout*),
+            'backoff' (retry with exponentially increasing delays) or 'auto' (the former if
+            there is no timeout). Defaults to what's set in config ('auto').
+            Lock-wait metrics are given by `f.lock_stats()`.
     """
 
     def _decorator(func):
@@ -84,6 +116,12 @@ def persistf(
             hash_method=hash_method,
             local=local,
             alt_dirs=alt_dirs,
+            adaptive=adaptive,
+            dedup=dedup,
+            lazy=lazy,
+            serializer=serializer,
+            lock_timeout=lock_timeout,
+            lock_wait=lock_wait,
         )
 
     return _decorator
@@ -93,6 +131,7 @@ def clear_locks(clear=False):
     """This function clears ALL locks for your project, if any.
     Such locks could be created in multi-process usage of persist_to_disk.
     Please only use it when you are sure no process is still using these locks to access files.
+    (Locks held by dead processes are released by the OS, so this is not needed after crashes.)
 
     Args:
         clear (bool, optional):
@@ -111,6 +150,107 @@ def clear_locks(clear=False):
             print(os.path.join(root, name))
 
 
+def batch(max_workers: int = None) -> WriteBatch:
+    """Context manager that buffers the writes of all persisted functions in memory,
+    and applies them grouped by bucket (one lock and one rewrite per bucket) on exit.
+    Reads inside the block see the pending writes.
+
+    Example:
+        with ptd.batch():
+            for a in range(1000):
+                func(a)
+
+    Args:
+        max_workers (int, optional):
+            Number of threads to write the buckets on exit. Defaults to None.
+    """
+    return WriteBatch(max_workers=max_workers)
+
+
+def _get_persister(func) -> Persister:
+    if isinstance(func, Persister):
+        return func
+    assert hasattr(func, 'persister'), f"{func} is not decorated by persistf."
+    return func.persister
+
+
+def warmup(func: Callable, partitions: Union[dict, List[dict]] = None, max_workers: int = None) -> int:
+    """Load the cache of a function into the OS page cache (concurrently), ahead of a run.
+    This can be started in a background thread, to overlap with the rest of the startup.
+
+    Example:
+        ptd.warmup(train_a_model, partitions=[{'dataset': 'MNIST'}, {'dataset': 'CIFAR10'}])
+
+    Args:
+        func (Callable):
+            Function decorated by `persistf`.
+        partitions (Union[dict, List[dict]], optional):
+            Values of the *groupby* kwargs of the partitions to load.
+            Defaults to None (all partitions).
+        max_workers (int, optional):
+            Number of threads to read the buckets. Defaults to None.
+
+    Returns:
+        int: number of buckets prefetched.
+    """
+    obj = _get_persister(func)
+    if partitions is None:
+        partitions = [{}]
+    elif isinstance(partitions, dict):
+        partitions = [partitions]
+    return sum(obj.warmup(max_workers=max_workers, **_) for _ in partitions)
+
+
+def export_cache(func_or_path: Union[Callable, str], archive: str) -> int:
+    """Pack the cache of a function into a single archive file,
+    which is much faster to transfer than the many bucket files.
+
+    Args:
+        func_or_path (Union[Callable, str]):
+            Function decorated by `persistf`, or its cache directory.
+        archive (str):
+            Path of the archive to write.
+
+    Returns:
+        int: number of entries exported.
+    """
+    if isinstance(func_or_path, str):
+        return persister.export_cache(os.path.abspath(func_or_path), archive)
+    return _get_persister(func_or_path).export_cache(archive)
+
+
+def import_cache(
+    archive: str,
+    func_or_path: Union[Callable, str] = None,
+    in_place: bool = False,
+    overwrite: bool = False,
+) -> int:
+    """Merge the entries of an archive made by `export_cache` into the cache of a function.
+    Keys are re-hashed with the *hashsize* and *hash_method* of the target.
+
+    Args:
+        archive (str):
+            Path of the archive.
+        func_or_path (Union[Callable, str], optional):
+            Function decorated by `persistf`, or its cache directory.
+            Defaults to the same function (relative to the project) as the exported one.
+        in_place (bool, optional):
+            Read the entries from the archive (on cache misses) instead of copying them.
+            Only available if *func_or_path* is a function.
+            Defaults to False.
+        overwrite (bool, optional):
+            Overwrite existing entries. Defaults to False.
+
+    Returns:
+        int: number of entries imported (or available in the archive, if *in_place*).
+    """
+    if func_or_path is None or isinstance(func_or_path, str):
+        assert not in_place, "Reading the archive in place requires a function."
+        cache_dir = None if func_or_path is None else os.path.abspath(func_or_path)
+        return persister.import_cache(archive, cache_dir, config, overwrite=overwrite)
+    return _get_persister(func_or_path).import_cache(archive, in_place=in_place, overwrite=overwrite)
+
+
 def get_caller_cache_path(make_if_necessary=True):
     """infer the cache path for the caller, for manual cache.
 
@@ -170,7 +310,8 @@ def manual_cache(
     )
 
 
-__all__ = ["config", "clear_locks", "persistf", "get_caller_cache_path", "manual_cache"]
+__all__ = ["config", "clear_locks", "persistf", "get_caller_cache_path", "manual_cache",
+           "export_cache", "import_cache", "LazyValue", "batch", "register_serializer", "warmup"]
 
 __version__ = "0.0.7"
 __author__ = "Zhen Lin"
@@ -0,0 +1,95 @@
+""" Adaptive caching policy.
+
+Records how long a function takes to compute and how long it takes to read its cache.
+If reading is (on average) slower than computing, the results are kept in memory only
+(or not cached at all, if they are big), until computing becomes slower again.
+"""
+import collections
+import threading
+import time
+from typing import Any, Tuple
+
+from . import _utils
+
+PERSIST, MEMORY, SKIP = 'persist', 'memory', 'skip'
+
+MIN_SAMPLES = 3  # Number of reads and computations before making any decision
+EMA_WEIGHT = 0.2  # Weight of a new sample in the moving averages
+MARGIN = 0.5  # Relative difference needed to change the decision (to avoid flipping back and forth)
+MEMORY_MAX_VALUE_SIZE = 1 << 20  # Bigger values are not kept in memory
+MEMORY_MAX_ENTRIES = 1024
+
+
+class AdaptivePolicy:
+    """Decides whether to persist the results of one function."""
+
+    def __init__(self) -> None:
+        self.decision = PERSIST
+        self.stats = {'compute_time': None, 'read_time': None, 'value_size': None,
+                      'n_computed': 0, 'n_read': 0}
+        self.history = []  # (timestamp, decision, reason)
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _ema(old, new):
+        return new if old is None else (1 - EMA_WEIGHT) * old + EMA_WEIGHT * new
+
+    def record_compute(self, duration: float, val: Any):
+        with self._lock:
+            if self.stats['n_computed'] < MIN_SAMPLES:
+                # Only pickle the first few values to learn their size
+                self.stats['value_size'] = self._ema(self.stats['value_size'], len(_utils.dumps(val)))
+            self.stats['compute_time'] = self._ema(self.stats['compute_time'], duration)
+            self.stats['n_computed'] += 1
+            self._update()
+
+    def record_read(self, duration: float):
+        with self._lock:
+            self.stats['read_time'] = self._ema(self.stats['read_time'], duration)
+            self.stats['n_read'] += 1
+            self._update()
+
+    def _update(self):
+        if self.stats['n_computed'] < MIN_SAMPLES or self.stats['n_read'] < MIN_SAMPLES:
+            return
+        read_time, compute_time = self.stats['read_time'], self.stats['compute_time']
+        if self.decision == PERSIST:
+            persist = read_time <= compute_time * (1 + MARGIN)
+        else:
+            persist = read_time * (1 + MARGIN) < compute_time
+        if persist:
+            decision = PERSIST
+        elif self.stats['value_size'] <= MEMORY_MAX_VALUE_SIZE:
+            decision = MEMORY
+        else:
+            decision = SKIP
+        if decision != self.decision:
+            reason = f"read_time={read_time:.3g}s, compute_time={compute_time:.3g}s, " \
+                     f"value_size={self.stats['value_size']:.0f}B"
+            self.history.append((time.time(), decision, reason))
+            self.decision = decision
+            if decision != MEMORY:
+                self._memory.clear()
+
+    def memory_get(self, key: bytes) -> Tuple[bool, Any]:
+        with self._lock:
+            if key not in self._memory:
+                return False, None
+            self._memory.move_to_end(key)
+            return True, self._memory[key]
+
+    def memory_put(self, key: bytes, val: Any):
+        with self._lock:
+            self._memory[key] = val
+            while len(self._memory) > MEMORY_MAX_ENTRIES:
+                self._memory.popitem(last=False)
+
+    def memory_clear(self):
+        with self._lock:
+            self._memory.clear()
+
+    def report(self) -> dict:
+        with self._lock:
+            return dict(self.stats, decision=self.decision, history=list(self.history),
+                        n_in_memory=len(self._memory))
@@ -0,0 +1,110 @@
+""" Single-file archive of a function's cache, for fast transfer between nodes.
+
+    magic(8) | frames (as in buckets, with the partition in the meta) | index | index offset(8) | b'PTDI'
+
+The index maps (partition, key) to where the value is, so that the archive could be read in place.
+If the index is lost (e.g. a truncated transfer), it is rebuilt by scanning the frames.
+"""
+import mmap
+import os
+import pickle
+import struct
+from typing import Any, Iterator, Tuple
+
+from . import _bucket, _utils
+
+MAGIC = b'PTDA\x01\x00\x00\x00'
+_TRAILER = struct.Struct('<Q4s')
+_TRAILER_MAGIC = b'PTDI'
+
+
+class ArchiveWriter:
+    """Streams entries into a new archive."""
+
+    def __init__(self, path: str, header: dict = None) -> None:
+        self.path = path
+        self.header = header or {}
+        self.index = {}
+        self._tmp_path = f"{path}.{os.getpid()}.tmp"
+        self._fout = open(self._tmp_path, 'wb')
+        self._fout.write(MAGIC)
+
+    def add(self, partition: str, key, entry: _bucket.Entry):
+        frame = _bucket.pack_frame(key, _bucket.Entry(dict(entry.meta, p=partition), entry.data))
+        offset = self._fout.tell() + len(frame) - len(entry.data)
+        self._fout.write(frame)
+        self.index[(partition, key)] = _bucket.EntryInfo(entry.meta, offset, len(entry.data))
+
+    def close(self):
+        index_offset = self._fout.tell()
+        _utils.dump({'header': self.header, 'index': self.index}, self._fout)
+        self._fout.write(_TRAILER.pack(index_offset, _TRAILER_MAGIC))
+        self._fout.close()
+        os.replace(self._tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args, **kwargs):
+        if exc_type is None:
+            self.close()
+        else:
+            self._fout.close()
+            os.remove(self._tmp_path)
+
+
+class ArchiveReader:
+    """Reads an archive (memory-mapped)."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, 'rb') as fin:
+            self._buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        assert self._buf[:len(MAGIC)] == MAGIC, f"{path} is not an archive of persist_to_disk."
+        self.header, self.index, self._end = {}, None, len(self._buf)
+        if len(self._buf) >= len(MAGIC) + _TRAILER.size:
+            index_offset, trailer_magic = _TRAILER.unpack(self._buf[-_TRAILER.size:])
+            if trailer_magic == _TRAILER_MAGIC and index_offset < len(self._buf):
+                try:
+                    meta = pickle.loads(self._buf[index_offset:-_TRAILER.size])
+                    self.header, self.index, self._end = meta['header'], meta['index'], index_offset
+                except Exception as err:  # pylint: disable=broad-except
+                    print(f"Error: {err}. Cannot read the index of {path}")
+        if self.index is None:
+            print(f"Rebuilding the index of {path}")
+            self.index = {(meta['p'], key): _bucket.EntryInfo({k: v for k, v in meta.items() if k != 'p'}, start, length)
+                          for key, meta, start, length, _, ok in self._scan(check_values=False) if ok}
+
+    def _scan(self, check_values=True):
+        return _bucket.scan(self._buf, check_values=check_values, start=len(MAGIC), end=self._end)
+
+    def entries(self) -> Iterator[Tuple[str, Any, _bucket.EntryInfo]]:
+        """Iterate over the intact entries as (partition, key, EntryInfo)."""
+        for key, meta, start, length, _, ok in self._scan():
+            if not ok:
+                print(f"Skipping a corrupted entry in {self.path}")
+                continue
+            partition = meta.pop('p')
+            yield partition, key, _bucket.EntryInfo(meta, start, length)
+
+    def read(self, info: _bucket.EntryInfo) -> _bucket.Entry:
+        return _bucket.Entry(info.meta, self._buf[info.offset:info.offset + info.size])
+
+    def get(self, partition: str, key) -> Tuple[bool, Any]:
+        info = self.index.get((partition, key))
+        if info is None:
+            return False, None
+        return True, self.read(info).load()
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        self._buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
@@ -0,0 +1,243 @@
+""" On-disk format of the hash buckets.
+
+A bucket is a sequence of frames, one per cached entry:
+
+    magic(4) | header_crc(4) | value_crc(4) | meta_len(4) | key_len(4) | value_len(8) | meta | key | value
+
+*meta* is a small json dict, *key* is pickled, and *value* is pickled unless *meta* names another
+serializer (`f`, see `_serializers`).
+With a value store, the value is written once under its content hash, and the frame only holds
+a reference to it (the hash, `ref` in *meta*, so that the cache can be moved).
+*header_crc* covers everything between itself and the value, so corrupted or truncated
+frames can be skipped (and the remaining ones salvaged) without unpickling any value.
+Buckets written by older versions (a single pickled dict) can still be read.
+"""
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterator, NamedTuple, Optional, Tuple
+
+from . import _serializers, _utils
+
+MAGIC = b'PTD\x01'
+_FRAME = struct.Struct('<4sIIIIQ')
+
+
+class Entry(NamedTuple):
+    """A cached value, still serialized (with pickle, unless the meta says otherwise in 'f')."""
+    meta: dict
+    data: bytes
+
+    def load(self, value_store: str = None) -> Any:
+        return _serializers.loads(self.meta.get('f', _serializers.DEFAULT), self.inline(value_store).data)
+
+    def inline(self, value_store: str = None) -> 'Entry':
+        """The same entry, with the value read from *value_store* if it is a reference.
+        Raises FileNotFoundError if the value is not there (or there is no value store).
+        """
+        if 'ref' not in self.meta:
+            return self
+        if value_store is None:
+            raise FileNotFoundError(f"The value {self.meta['ref']} is in a value store, but none is given.")
+        with open(value_path(value_store, self.meta['ref']), 'rb') as fin:
+            data = fin.read()
+        return Entry({k: v for k, v in self.meta.items() if k not in {'ref', 's'}}, data)
+
+    def has_value(self, value_store: str = None) -> bool:
+        """Whether the value is there (values in a value store might have been collected), without reading it."""
+        return 'ref' not in self.meta or (
+            value_store is not None and os.path.isfile(value_path(value_store, self.meta['ref'])))
+
+
+def value_path(value_store: str, digest: str) -> str:
+    return os.path.join(value_store, digest[:2], f"{digest}.pkl")
+
+
+def store_value(value_store: str, data: bytes) -> str:
+    """Write *data* (once) under its content hash, and return the hash.
+    If it is already there, its mtime is refreshed so that the garbage collection leaves it alone.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    path = value_path(value_store, digest)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as fout:
+            fout.write(data)
+        os.replace(tmp_path, path)
+    return digest
+
+
+def encode_entry(val, value_store: str = None, serializer: str = 'auto', **meta) -> Entry:
+    meta.setdefault('t', time.time())
+    fmt, data = _serializers.dumps(val, serializer)
+    if fmt != _serializers.DEFAULT:
+        meta['f'] = fmt
+    entry = Entry(meta, data)
+    return entry if value_store is None else to_ref(entry, value_store)
+
+
+def to_ref(entry: Entry, value_store: str) -> Entry:
+    """Move the value of *entry* to the value store."""
+    if 'ref' in entry.meta:
+        return entry
+    data = bytes(entry.data)
+    return Entry(dict(entry.meta, ref=store_value(value_store, data), s=len(data)), b'')
+
+
+def pack_frame(key, entry: Entry) -> bytes:
+    meta = json.dumps(entry.meta, separators=(',', ':')).encode('utf-8')
+    key = _utils.dumps(key)
+    fields = _FRAME.pack(MAGIC, 0, zlib.crc32(entry.data), len(meta), len(key), len(entry.data))
+    header_crc = zlib.crc32(fields[8:] + meta + key)
+    return b''.join([MAGIC, struct.pack('<I', header_crc), fields[8:], meta, key, entry.data])
+
+
+def scan(buf, check_values=True, start=0, end=None) -> Iterator[Tuple[Any, dict, int, int, int, bool]]:
+    """Iterate over the frames in *buf* (bytes or mmap), between *start* and *end*.
+
+    Yields (key, meta, value offset, value length, value crc, whether the frame is ok).
+    Frames with a broken header are reported with key=None, and scanning resumes at the next magic.
+    Values are only read to check their crc if *check_values*.
+    """
+    pos, n = start, len(buf) if end is None else end
+    while pos < n:
+        ok = n - pos >= _FRAME.size and buf[pos:pos + 4] == MAGIC
+        if ok:
+            _, header_crc, value_crc, meta_len, key_len, value_len = _FRAME.unpack(buf[pos:pos + _FRAME.size])
+            meta_start = pos + _FRAME.size
+            key_start = meta_start + meta_len
+            value_start = key_start + key_len
+            value_end = value_start + value_len
+            ok = value_end <= n and zlib.crc32(buf[pos + 8:value_start]) == header_crc
+        if not ok:
+            yield None, None, pos, 0, 0, False
+            pos = buf.find(MAGIC, pos + 1, n)
+            if pos == -1:
+                return
+            continue
+        meta = json.loads(bytes(buf[meta_start:key_start]).decode('utf-8'))
+        key = pickle.loads(buf[key_start:value_start])
+        ok = not check_values or zlib.crc32(buf[value_start:value_end]) == value_crc
+        yield key, meta, value_start, value_len, value_crc, ok
+        pos = value_end
+
+
+class EntryInfo(NamedTuple):
+    """Where an entry is in the bucket (offset is None for the legacy format), and its meta."""
+    meta: dict
+    offset: Optional[int]
+    size: int
+
+
+def read_index(cache_path) -> Dict[Any, EntryInfo]:
+    """Read the keys and meta of a bucket, without reading (let alone unpickling) the values.
+    Corrupted frames are skipped.
+    """
+    with open(cache_path, 'rb') as fin:
+        if os.fstat(fin.fileno()).st_size == 0:
+            return {}
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if buf[:len(MAGIC)] == MAGIC:
+                return {key: EntryInfo(meta, start, length)
+                        for key, meta, start, length, _, ok in scan(buf, check_values=False) if ok}
+    return {k: EntryInfo(v.meta, None, len(v.data)) for k, v in read_entries(cache_path)[0].items()}
+
+
+def _read_buffer(cache_path) -> bytes:
+    with open(cache_path, 'rb') as fin:
+        return fin.read()
+
+
+def read_entries(cache_path) -> Tuple[Dict[Any, Entry], int]:
+    """Read all the intact entries of a bucket, without unpickling the values.
+
+    Returns (entries, number of corrupted frames).
+    Raises FileNotFoundError if the bucket does not exist.
+    """
+    buf = _read_buffer(cache_path)
+    if len(buf) > 0 and not buf.startswith(MAGIC):
+        try:  # legacy format
+            # The write time of legacy entries is unknown
+            return {k: encode_entry(v, serializer=_serializers.DEFAULT, t=None)
+                    for k, v in pickle.loads(buf).items()}, 0
+        except Exception as err:  # pylint: disable=broad-except
+            if MAGIC not in buf:
+                print(f"Error: {err}. Cannot read {cache_path}")
+                return {}, 1
+    entries, n_bad = {}, 0
+    for key, meta, start, length, _, ok in scan(buf):
+        if ok:
+            entries[key] = Entry(meta, buf[start:start + length])
+        else:
+            n_bad += 1
+    return entries, n_bad
+
+
+def load_entries(cache_path) -> Dict[Any, Entry]:
+    """Like read_entries, but salvages a corrupted bucket by rewriting the intact entries
+    (the original file is kept as *.corrupted*). To be called with the lock held.
+    """
+    if not os.path.isfile(cache_path):
+        return {}
+    entries, n_bad = read_entries(cache_path)
+    if n_bad > 0:
+        backup = f"{cache_path}.corrupted"
+        print(f"Error: {n_bad} corrupted entries in {cache_path}. "
+              f"Salvaged {len(entries)} entries, and moved the original to {backup}.")
+        os.replace(cache_path, backup)
+        write_entries(cache_path, entries)
+    return entries
+
+
+def read_values(cache_path, value_store: str = None) -> Dict[Any, Any]:
+    """Read and deserialize all the intact entries of a bucket."""
+    return {k: v.load(value_store) for k, v in read_entries(cache_path)[0].items()}
+
+
+def write_entries(cache_path, entries: Dict[Any, Entry]):
+    """(Re-)write the bucket atomically."""
+    tmp_path = f"{cache_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as fout:
+        for key, entry in entries.items():
+            fout.write(pack_frame(key, entry))
+    os.replace(tmp_path, cache_path)
+
+
+def verify(cache_path) -> int:
+    """Check the crc of every frame without unpickling the values.
+
+    Returns the number of corrupted frames (buckets in the legacy format are not checked).
+    """
+    buf = _read_buffer(cache_path)
+    if len(buf) > 0 and MAGIC not in buf:
+        return 0
+    return sum(not ok for *_, ok in scan(buf))
+
+
+_PREFETCH_CHUNK = 1 << 20
+
+
+def prefetch(path) -> int:
+    """Bring a file into the OS page cache, without keeping it in memory.
+
+    Returns the number of bytes read.
+    """
+    with open(path, 'rb', buffering=0) as fin:
+        if hasattr(os, 'posix_fadvise'):
+            # Let the kernel read ahead the whole file, instead of chunk by chunk
+            os.posix_fadvise(fin.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        chunk, cnt = bytearray(_PREFETCH_CHUNK), 0
+        while True:
+            n = fin.readinto(chunk)
+            if not n:
+                return cnt
+            cnt += n
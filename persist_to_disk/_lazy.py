@@ -0,0 +1,138 @@
+""" Lazy handles to cached values.
+"""
+import mmap
+import os
+import threading
+import zlib
+from typing import Any, Optional
+
+from . import _bucket, _serializers
+
+
+def _identity(val):
+    return val
+
+
+def _signature(st: os.stat_result):
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class LazyValue(object):
+    """Handle to a cached value, which is only deserialized on first access
+    (`.get()`, or any attribute/item access which is forwarded to the value).
+
+    For buckets in the framed format, the handle only remembers where the entry is, and reads
+    just this entry on first access (checking its crc). If the bucket was rewritten in the meantime,
+    the entry is located again. KeyError is raised if it was removed (or its value was collected
+    from the value store, or is corrupted).
+    """
+    __slots__ = ('_entry', '_value_store', '_cache_path', '_key', '_signature', '_offset', '_size', '_crc',
+                 '_value', '_loaded', '_lock')
+
+    def __init__(self, entry: _bucket.Entry = None, value_store: str = None) -> None:
+        self._entry, self._value_store = entry, value_store
+        self._cache_path = self._key = self._signature = self._offset = self._size = self._crc = None
+        self._value, self._loaded = None, False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_value(cls, val) -> 'LazyValue':
+        handle = cls()
+        handle._value, handle._loaded = val, True
+        return handle
+
+    @classmethod
+    def from_bucket(cls, cache_path, key, value_store: str = None) -> Optional['LazyValue']:
+        """Locate *key* in the bucket without reading any value. None if it is not there.
+        Raises FileNotFoundError if the bucket does not exist.
+        """
+        with open(cache_path, 'rb') as fin:
+            st = os.fstat(fin.fileno())
+            if st.st_size == 0:
+                return None
+            with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                if buf[:len(_bucket.MAGIC)] == _bucket.MAGIC:
+                    for _key, meta, start, length, crc, ok in _bucket.scan(buf, check_values=False):
+                        if ok and _key == key:
+                            handle = cls(_bucket.Entry(meta, b''), value_store)
+                            if 'ref' not in meta:
+                                handle._cache_path, handle._key, handle._signature = cache_path, key, _signature(st)
+                                handle._offset, handle._size, handle._crc = start, length, crc
+                            return handle
+                    return None
+        # legacy format
+        entry = _bucket.read_entries(cache_path)[0].get(key)
+        return None if entry is None else cls(entry, value_store)
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def has_value(self) -> bool:
+        """Whether the value can still be loaded, without reading it (as far as it can be known)."""
+        return self._loaded or self._cache_path is not None or self._entry.has_value(self._value_store)
+
+    def _read(self) -> Optional[bytes]:
+        """The serialized value, or None if the bucket was rewritten (or the value is corrupted)."""
+        try:
+            with open(self._cache_path, 'rb') as fin:
+                # Inode numbers are re-used by rewrites, so the size and mtime are compared too
+                if _signature(os.fstat(fin.fileno())) != self._signature:
+                    return None
+                fin.seek(self._offset)
+                data = fin.read(self._size)
+        except FileNotFoundError:
+            return None
+        return data if zlib.crc32(data) == self._crc else None
+
+    def _load(self) -> Any:
+        if self._cache_path is None:
+            try:
+                return self._entry.load(self._value_store)
+            except FileNotFoundError as err:
+                # The value was collected from the value store
+                raise KeyError(str(err)) from err
+        data = self._read()
+        if data is None:
+            # The bucket was rewritten: locate the entry again
+            try:
+                handle = LazyValue.from_bucket(self._cache_path, self._key, self._value_store)
+            except FileNotFoundError:
+                handle = None
+            if handle is None:
+                raise KeyError(f"{self._key} was removed from {self._cache_path}.")
+            if handle._cache_path is None:
+                return handle._load()
+            data = handle._read()
+            if data is None:
+                raise KeyError(f"The value of {self._key} in {self._cache_path} is corrupted.")
+        return _serializers.loads(self._entry.meta.get('f', _serializers.DEFAULT), data)
+
+    def get(self) -> Any:
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._value = self._load()
+                    self._entry = self._cache_path = self._key = None
+                    self._loaded = True
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __getitem__(self, item):
+        return self.get()[item]
+
+    def __len__(self):
+        return len(self.get())
+
+    def __iter__(self):
+        return iter(self.get())
+
+    def __repr__(self):
+        if self._loaded:
+            return f"LazyValue({self._value!r})"
+        return "LazyValue(<not loaded>)"
+
+    def __reduce__(self):
+        return _identity, (self.get(),)
@@ -0,0 +1,164 @@
+""" Registry of serializers for cached values.
+
+By default (`serializer='auto'`), the serializer is picked by the exact type of the value:
+NumPy arrays are written in the `.npy` format, pandas DataFrames with Arrow (if `pyarrow`
+is installed and preserves them) or pickle protocol 5 with out-of-band buffers, and PyTorch tensors with `torch.save`.
+Everything else uses plain pickle. The serializer used is recorded with each entry.
+"""
+import io
+import pickle
+import struct
+from typing import Any, Callable, Iterable, NamedTuple, Union
+
+from . import _utils
+
+DEFAULT = 'pickle'
+
+
+class Serializer(NamedTuple):
+    name: str
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[Any], Any]  # takes a bytes-like object
+
+
+_serializers = {}
+_type_to_serializer = {}  # qualified name of the type -> serializer name
+
+
+def _qualname(cls) -> str:
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
+def register_serializer(name: str, dumps: Callable[[Any], bytes], loads: Callable[[Any], Any],
+                        types: Iterable[Union[type, str]] = ()):
+    """Register a serializer.
+
+    Args:
+        name (str):
+            Name of the serializer, recorded with each entry (so it must be registered
+            under the same name wherever the cache is read).
+        dumps (Callable[[Any], bytes]):
+            Serializes a value.
+        loads (Callable[[Any], Any]):
+            Deserializes a value from a bytes-like object.
+        types (Iterable[Union[type, str]], optional):
+            Types (or their qualified names, like "numpy.ndarray") that use this serializer
+            in 'auto' mode. Only exact types match (not subclasses).
+            Defaults to ().
+    """
+    _serializers[name] = Serializer(name, dumps, loads)
+    for cls in types:
+        _type_to_serializer[cls if isinstance(cls, str) else _qualname(cls)] = name
+
+
+def is_registered(name: str) -> bool:
+    return name in _serializers
+
+
+def dumps(obj, serializer: str = 'auto'):
+    """Serialize *obj*. Returns (name of the serializer used, bytes).
+    If the chosen serializer fails, falls back to pickle.
+    """
+    if serializer == 'auto':
+        serializer = _type_to_serializer.get(_qualname(type(obj)), DEFAULT)
+    assert serializer in _serializers, f"Unknown serializer {serializer}."
+    if serializer != DEFAULT:
+        try:
+            return serializer, _serializers[serializer].dumps(obj)
+        except Exception as err:  # pylint: disable=broad-except
+            print(f"Serializer {serializer} failed ({err}). Using pickle instead.")
+    return DEFAULT, _utils.dumps(obj)
+
+
+def loads(serializer: str, data):
+    assert serializer in _serializers, \
+        f"Unknown serializer {serializer}. Please register it with `register_serializer`."
+    return _serializers[serializer].loads(data)
+
+
+# Built-in serializers ==================
+def _pickle5_dumps(obj) -> bytes:
+    """Pickle protocol 5, with the (e.g. array) buffers appended raw after the pickle."""
+    buffers = []
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+    raws = [_.raw() for _ in buffers]
+    header = struct.pack(f'<Q{len(raws) + 1}Q', len(raws), len(data), *[_.nbytes for _ in raws])
+    return b''.join([header, data] + raws)
+
+
+def _pickle5_loads(buf):
+    buf = memoryview(buf)
+    n_buffers, = struct.unpack_from('<Q', buf)
+    lengths = struct.unpack_from(f'<{n_buffers + 1}Q', buf, 8)
+    pos = 8 * (n_buffers + 2)
+    data, pos = buf[pos:pos + lengths[0]], pos + lengths[0]
+    buffers = []
+    for length in lengths[1:]:
+        buffers.append(bytearray(buf[pos:pos + length]))  # writable copies
+        pos += length
+    return pickle.loads(data, buffers=buffers)
+
+
+def _numpy_dumps(arr) -> bytes:
+    """The `.npy` format, where arrays of python objects are pickled."""
+    import numpy as np
+    fout = io.BytesIO()
+    np.lib.format.write_array(fout, arr, allow_pickle=arr.dtype.hasobject)
+    return fout.getvalue()
+
+
+def _numpy_loads(buf):
+    import numpy as np
+    return np.lib.format.read_array(io.BytesIO(buf), allow_pickle=True)
+
+
+def _arrow_preserves(df) -> bool:
+    """Whether *df* is read back equal from Arrow: no python objects, unique string column names,
+    and nothing that Arrow drops (the frequency of the index, attrs and flags)."""
+    return (not any(_ == object for _ in df.dtypes) and all(isinstance(_, str) for _ in df.columns)
+            and df.columns.is_unique and getattr(df.index, 'freq', None) is None
+            and not getattr(df, 'attrs', None)
+            and getattr(getattr(df, 'flags', None), 'allows_duplicate_labels', True))
+
+
+def _dataframe_dumps(df) -> bytes:
+    """Arrow IPC if pyarrow is installed and preserves *df*, else pickle5."""
+    try:
+        import pyarrow as pa
+    except ImportError:
+        pa = None
+    if pa is None or not _arrow_preserves(df):
+        return b'P' + _pickle5_dumps(df)
+    table = pa.Table.from_pandas(df)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return b'A' + sink.getvalue().to_pybytes()
+
+
+def _dataframe_loads(buf):
+    buf = memoryview(buf)
+    if bytes(buf[:1]) == b'P':
+        return _pickle5_loads(buf[1:])
+    import pyarrow as pa
+    return pa.ipc.open_stream(pa.py_buffer(buf[1:])).read_all().to_pandas()
+
+
+def _torch_dumps(tensor) -> bytes:
+    import torch
+    fout = io.BytesIO()
+    torch.save(tensor, fout)
+    return fout.getvalue()
+
+
+def _torch_loads(buf):
+    import torch
+    return torch.load(io.BytesIO(buf))
+
+
+register_serializer(DEFAULT, _utils.dumps, pickle.loads)
+register_serializer('pickle5', _pickle5_dumps, _pickle5_loads)
+register_serializer('numpy', _numpy_dumps, _numpy_loads, types=['numpy.ndarray'])
+register_serializer('dataframe', _dataframe_dumps, _dataframe_loads,
+                    types=['pandas.DataFrame', 'pandas.core.frame.DataFrame'])
+register_serializer('torch', _torch_dumps, _torch_loads, types=['torch.Tensor'])
@@ -15,6 +15,13 @@ def dump(obj, file, **kwargs):
     return pickle.dump(obj, file, **kwargs)
 
 
+def dumps(obj, **kwargs):
+    """like pickle.dumps but fix a default protocol for compatibility.
+    """
+    kwargs.setdefault('protocol', PICKLE_PROTOCOL)
+    return pickle.dumps(obj, **kwargs)
+
+
 def to_pickle(obj, filepath, **kwargs):
     """Like to_pickle in pandas, but avoids pandas dependency.
     """
@@ -45,10 +52,10 @@ def make_dir_if_necessary(dirname, max_depth=3):
     assert max_depth >= 0, f"Cannot make too many nested directories. Something could be wrong!, dirname={dirname}"
     if not os.path.isdir(os.path.dirname(dirname)):
         make_dir_if_necessary(os.path.dirname(dirname), max_depth - 1)
-    fl = FileLock(dirname)
-    with fl:
-        print(f"{dirname} does not exist. Creating it for persist_to_disk")
-        os.makedirs(dirname)
+    with FileLock(dirname):
+        if not os.path.isdir(dirname):
+            print(f"{dirname} does not exist. Creating it for persist_to_disk")
+            os.makedirs(dirname, exist_ok=True)
     return
 
 
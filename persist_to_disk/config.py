@@ -4,6 +4,7 @@ import os
 from pathlib import Path
 
 from . import _utils
+from . import myfilelock
 from .myfilelock import FileLock
 
 SETTING_PATH = os.path.join(Path.home(), '.cache', 'persist_to_disk')
@@ -77,6 +78,11 @@ class Config(dict):
         self._private_config = {'_persist_path': {}}
         for key in ['hashsize', 'lock_granularity']:
             self.config[key] = self.global_config['global_settings'][key]
+        # Optional: Unix socket of a running `persist_to_disk.server`
+        self.config['server_address'] = self.global_config['global_settings'].get('server_address', None)
+        # Optional: how long (in seconds, negative to wait forever) and how to wait for locks
+        self.set_lock_timeout(self.global_config['global_settings'].get('lock_timeout', myfilelock.DEFAULT_TIMEOUT))
+        self.set_lock_wait(self.global_config['global_settings'].get('lock_wait', myfilelock.DEFAULT_WAIT))
         assert self.config['lock_granularity'] in {"call", "func", "global"}
 
     def generate_config(self):
@@ -100,6 +106,24 @@ class Config(dict):
         self.config['hashsize'] = hashsize
         return hashsize
 
+    def set_server_address(self, address=None):
+        """Use the cache server listening at *address* (None to access files directly)."""
+        self.config['server_address'] = address
+        return address
+
+    def set_lock_timeout(self, timeout=myfilelock.DEFAULT_TIMEOUT):
+        """Default time (in seconds) to wait for a lock before raising Timeout. Negative to wait forever."""
+        self.config['lock_timeout'] = float(timeout)
+        return self.config['lock_timeout']
+
+    def set_lock_wait(self, wait=myfilelock.DEFAULT_WAIT):
+        """Default way to wait for a lock: 'block' (OS-level wait, forever regardless of the timeout),
+        'backoff' (retry with exponentially increasing delays) or 'auto' (the former if there is no timeout).
+        """
+        assert wait in myfilelock.WAIT_STRATEGIES, f"wait should be one of {myfilelock.WAIT_STRATEGIES}, but got {wait}."
+        self.config['lock_wait'] = wait
+        return wait
+
     def set_alternative_readonly_persist_paths(self, paths):
         raise NotImplementedError()
 
@@ -126,3 +150,12 @@ class Config(dict):
 
     def get_hashsize(self):
         return int(self.config['hashsize'])
+
+    def get_server_address(self):
+        return self.config['server_address']
+
+    def get_lock_timeout(self):
+        return self.config['lock_timeout']
+
+    def get_lock_wait(self):
+        return self.config['lock_wait']
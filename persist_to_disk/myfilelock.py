@@ -1,25 +1,218 @@
+import errno
+import os
+import socket
+import threading
+import time
+from typing import NamedTuple, Optional
+
 from filelock import FileLock as RawFileLock
 from filelock import Timeout
 
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to filelock
+    fcntl = None
+
 assert Timeout is not None
 
+DEFAULT_TIMEOUT = 300  # seconds. Negative means waiting forever.
+DEFAULT_WAIT = 'auto'
+# 'block': blocking OS-level wait (flock), forever (the timeout is ignored).
+# 'backoff': retry with exponentially increasing delays, until the timeout.
+# 'auto': 'block' if there is no timeout, else 'backoff'.
+WAIT_STRATEGIES = {'auto', 'block', 'backoff'}
+
+MIN_DELAY = 0.001
+MAX_DELAY = 0.25
+
+_HOSTNAME = socket.gethostname()
+_stats_mutex = threading.Lock()
+_NEW_STATS = {'n_acquired': 0, 'n_contended': 0, 'wait_time': 0., 'max_wait_time': 0., 'n_timeouts': 0}
+
+
+class _PooledLock(object):
+    """A file lock shared by all threads of this process, guarded by a threading lock
+    so that only one thread at a time waits on (and holds) the file lock.
+
+    The locks are released by the OS when their owner dies, so there are no stale locks.
+    The owner ("hostname pid") is still written in the lock file, to tell who holds it on timeouts.
+    """
+
+    def __init__(self, lock_path) -> None:
+        self.lock_path = lock_path
+        self.thread_lock = threading.RLock()
+        self.file_lock = RawFileLock(lock_path) if fcntl is None else None
+        self.stats = {}  # tag -> lock-wait metrics
+        self._fd = None
+        self._depth = 0
+
+    def acquire(self, timeout=None, wait=None, tag=None):
+        timeout = DEFAULT_TIMEOUT if timeout is None else timeout
+        wait = DEFAULT_WAIT if wait is None else wait
+        if wait == 'auto':
+            wait = 'block' if timeout < 0 else 'backoff'
+        elif wait == 'block':
+            timeout = -1
+        start = time.time()
+        if not self.thread_lock.acquire(timeout=-1 if timeout < 0 else timeout):
+            self._record(tag, start, timed_out=True)
+            raise Timeout(self.lock_path)
+        try:
+            if self._depth == 0:
+                remaining = -1 if timeout < 0 else max(timeout - (time.time() - start), 0)
+                if self.file_lock is not None:
+                    self.file_lock.acquire(timeout=remaining)
+                else:
+                    self._fd = self._acquire_file(remaining, wait)
+                self._record(tag, start)
+            self._depth += 1
+        except Timeout:
+            owner = self._read_owner()
+            if owner is not None:
+                print(f"Timed out waiting for {self.lock_path}, held by process {owner[1]} on {owner[0]}")
+            self._record(tag, start, timed_out=True)
+            self.thread_lock.release()
+            raise
+        except BaseException:
+            self.thread_lock.release()
+            raise
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            if self.file_lock is not None:
+                self.file_lock.release()
+            else:
+                fd, self._fd = self._fd, None
+                try:
+                    os.ftruncate(fd, 0)
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                finally:
+                    os.close(fd)
+        self.thread_lock.release()
+
+    def _record(self, tag, start, timed_out=False):
+        duration = time.time() - start
+        with _stats_mutex:
+            stats = self.stats.setdefault(tag, dict(_NEW_STATS))
+            if timed_out:
+                stats['n_timeouts'] += 1
+            else:
+                stats['n_acquired'] += 1
+            if duration > MIN_DELAY:
+                stats['n_contended'] += 1
+            stats['wait_time'] += duration
+            stats['max_wait_time'] = max(stats['max_wait_time'], duration)
+
+    def _try_lock(self, blocking: bool):
+        """Returns the locked file descriptor, or None if it is locked by another process."""
+        while True:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_CLOEXEC', 0), 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as err:
+                os.close(fd)
+                if err.errno in {errno.EAGAIN, errno.EACCES}:
+                    return None
+                raise
+            except BaseException:
+                os.close(fd)
+                raise
+            # The lock file might have been removed (e.g. by `clear_locks`) while we were waiting
+            try:
+                same_file = os.fstat(fd).st_ino == os.stat(self.lock_path).st_ino
+            except FileNotFoundError:
+                same_file = False
+            if same_file:
+                os.ftruncate(fd, 0)
+                os.pwrite(fd, f"{_HOSTNAME} {os.getpid()}\n".encode('utf-8'), 0)
+                return fd
+            os.close(fd)
+
+    def _read_owner(self):
+        try:
+            with open(self.lock_path, 'r', encoding='utf-8') as fin:
+                host, pid = fin.read().split()
+            return host, int(pid)
+        except (OSError, ValueError):
+            return None
+
+    def _acquire_file(self, timeout, wait) -> int:
+        if wait == 'block':
+            return self._try_lock(blocking=True)
+        start, delay = time.time(), MIN_DELAY
+        while True:
+            fd = self._try_lock(blocking=False)
+            if fd is not None:
+                return fd
+            now = time.time()
+            if 0 <= timeout <= now - start:
+                raise Timeout(self.lock_path)
+            time.sleep(delay if timeout < 0 else min(delay, max(start + timeout - now, 0)))
+            delay = min(delay * 2, MAX_DELAY)
+
+
+class LockManager(object):
+    """Per-process pool of locks, so that the lock of each path is created once
+    and threads coordinate in memory before touching the file system.
+    """
+
+    def __init__(self) -> None:
+        self._mutex = threading.Lock()
+        self._locks = {}
+
+    def get(self, lock_path) -> _PooledLock:
+        with self._mutex:
+            lock = self._locks.get(lock_path)
+            if lock is None:
+                lock = self._locks[lock_path] = _PooledLock(lock_path)
+            return lock
+
+    def stats(self) -> dict:
+        """Lock-wait metrics of each lock used by this process, as {(lock path, tag): metrics}."""
+        with self._mutex:
+            locks = list(self._locks.values())
+        with _stats_mutex:
+            return {(lock.lock_path, tag): dict(stats) for lock in locks for tag, stats in lock.stats.items()}
+
+    def reset(self):
+        """Forget all the locks (e.g. in a forked child, which does not own them)."""
+        self._mutex = threading.Lock()
+        self._locks = {}
+
+
+lock_manager = LockManager()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=lock_manager.reset)
+
+
+class LockSpec(NamedTuple):
+    """Which file to lock, and how to wait for it (see `FileLock`)."""
+    path: str
+    timeout: Optional[float] = None
+    wait: Optional[str] = None
+    tag: Optional[str] = None
+
 
 class FileLock(object):
     """A wrapper for filelock.FileLock
     """
 
-    def __init__(self, protected_file_path, timeout=5):
+    def __init__(self, protected_file_path, timeout=None, wait=None, tag=None):
         """ Prepare the file locker. Specify the file to lock and optionally
-                the maximum timeout and the delay between each attempt to lock.
+                the maximum timeout (in seconds, negative to wait forever, DEFAULT_TIMEOUT if None),
+                the wait strategy (one of WAIT_STRATEGIES, DEFAULT_WAIT if None, 'block' ignores the timeout)
+                and a tag to record the lock-wait metrics under (see `LockManager.stats`).
         """
         self.lock_path = protected_file_path + ".lock"
-        self.lock = RawFileLock(self.lock_path, timeout=timeout)
+        self.timeout = timeout
+        self.wait = wait
+        self.tag = tag
+        self.lock = lock_manager.get(self.lock_path)
 
     def __enter__(self):
-        return self.lock.__enter__()
+        self.lock.acquire(self.timeout, self.wait, self.tag)
+        return self
 
     def __exit__(self, *args, **kwargs):
-        return self.lock.__exit__(*args, **kwargs)
-
-    def __del__(self):
-        return self.lock.__del__()
+        self.lock.release()
@@ -1,6 +1,7 @@
 """ Main script.
 """
 import argparse
+import concurrent.futures
 import copy
 import functools
 import glob
@@ -9,18 +10,20 @@ import inspect
 import json
 import os
 import pickle
-from typing import Any, Callable, List, Optional, Tuple, Union
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import six
 
-from . import _utils
+from . import _adaptive, _archive, _bucket, _lazy, _serializers, _utils, myfilelock
 from .config import Config
-from .myfilelock import FileLock, Timeout
+from .myfilelock import FileLock, LockSpec, Timeout
 
 _DEBUG = False
 NOCACHE, CACHE, RECACHE, READONLY, CHECKONLY = [0, 1, 2, 3, 4]
 # CHECKONLY checks if the cache is there, without actually reading it (so it could be corrupted as well)
-# This only makes sense for manual cache, not for the decorator, due to the hashing mechanism.
+# For the decorator, only the keys in the bucket are read (see `Persister.contains`).
 
 
 def _print(*args, **kwargs):
@@ -82,61 +85,493 @@ def _hash(k):
     return int(hashlib.md5(pickle.dumps(k, protocol=3)).hexdigest(), 16)
 
 
-def _persist_rw_curr_results(cache_path, write_key=None, write_val=None, *, lock_path):
-    if lock_path is None:
-        lock_path = cache_path  # lock at call level
-    with FileLock(lock_path):
+_HASH_FUNCS = {'pickle': _hash, 'json': _hash_tuple_json}
+
+
+_active_batches = []  # WriteBatch's in effect in this process, innermost last
+_active_batches_mutex = threading.Lock()
+
+
+def _reset_batches():
+    """Stop buffering in a forked child, which would never flush the batches of its parent."""
+    global _active_batches, _active_batches_mutex
+    _active_batches, _active_batches_mutex = [], threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_batches)
+
+
+class WriteBatch:
+    """Buffers the writes of persisted functions in memory, and applies them grouped by bucket
+    (with one lock and one rewrite per bucket) on exit. Reads inside the block see the pending writes.
+    The batch applies to all threads of this process.
+    """
+
+    def __init__(self, cache_dir: str = None, max_workers: int = None) -> None:
+        """Only buffer the writes under *cache_dir* (all writes if None)."""
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.pending = {}  # cache_path -> (lock, {key: entry})
+        self.closed = False  # Set by flush. Later writes are not buffered.
+        self.flushing = {}  # The pending writes being applied by flush
+        self._mutex = threading.Lock()
+
+    def covers(self, cache_path) -> bool:
+        return self.cache_dir is None or cache_path.startswith(os.path.join(self.cache_dir, ''))
+
+    def add(self, cache_path, key, entry: _bucket.Entry, *, lock: LockSpec) -> bool:
+        """Buffer the write. Returns False if the batch is already flushed (so the caller should write it)."""
+        with self._mutex:
+            if self.closed:
+                return False
+            self.pending.setdefault(cache_path, (lock, {}))[1][key] = entry
+            return True
+
+    def get(self, cache_path, key) -> Optional[_bucket.Entry]:
+        with self._mutex:
+            return self.pending.get(cache_path, (None, {}))[1].get(key)
+
+    def refs(self) -> set:
+        """The value-store references of the entries not written yet."""
+        with self._mutex:
+            return {entry.meta['ref'] for pending in [self.pending, self.flushing]
+                    for _, entries in pending.values() for entry in entries.values() if 'ref' in entry.meta}
+
+    def discard(self, cache_path, key_predicate: Callable[[dict], bool] = None):
+        """Drop the pending writes to *cache_path* (only those whose key satisfies *key_predicate* if given)."""
+        with self._mutex:
+            self._discard(cache_path, key_predicate)
+
+    def discard_dirs(self, dirnames: List[str], key_predicate: Callable[[dict], bool] = None):
+        """Same as `discard`, for all the buckets in *dirnames*."""
+        dirnames = set(dirnames)
+        with self._mutex:
+            for cache_path in list(self.pending.keys()):
+                if os.path.dirname(cache_path) in dirnames:
+                    self._discard(cache_path, key_predicate)
+
+    def _discard(self, cache_path, key_predicate: Callable[[dict], bool] = None):
+        if cache_path not in self.pending:
+            return
+        entries = self.pending[cache_path][1]
+        for key in [k for k in entries if key_predicate is None or key_predicate(dict(k))]:
+            entries.pop(key)
+
+    def flush(self) -> int:
+        """Write the pending entries. Returns the number of entries written."""
+        with self._mutex:
+            pending, self.pending, self.closed = self.pending, {}, True
+            self.flushing = pending
+        groups = {}
+        for cache_path, (lock, entries) in pending.items():
+            if len(entries) > 0:
+                groups.setdefault(lock, {})[cache_path] = entries
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+                futures = [pool.submit(_merge_buckets, buckets, lock=lock)
+                           for lock, buckets in groups.items()]
+                return sum(_.result() for _ in futures)
+        finally:
+            with self._mutex:
+                self.flushing = {}
+
+    def __enter__(self):
+        with self._mutex:
+            self.closed = False
+        with _active_batches_mutex:
+            _active_batches.append(self)
+        return self
+
+    def __exit__(self, *args, **kwargs):
         try:
-            res = _utils.read_pickle(cache_path)
-        except Exception as err:
-            if os.path.exists(cache_path):
-                print(f"Error: {err}. Re-creating a new cache")
-            res = {}
-            _utils.to_pickle(res, cache_path)
+            self.flush()
+        finally:
+            # Only after the flush, so that the garbage collection sees the references being written
+            with _active_batches_mutex:
+                if self in _active_batches:  # not in a forked child
+                    _active_batches.remove(self)
+
+
+def _get_batch(cache_path) -> Optional[WriteBatch]:
+    with _active_batches_mutex:
+        for batch in reversed(_active_batches):
+            if batch.covers(cache_path):
+                return batch
+    return None
+
+
+def _get_pending_entry(cache_path, key) -> Optional[_bucket.Entry]:
+    """The entry of *key* waiting to be written by a WriteBatch, if any."""
+    with _active_batches_mutex:
+        batches = list(reversed(_active_batches))
+    for batch in batches:
+        entry = batch.get(cache_path, key)
+        if entry is not None:
+            return entry
+    return None
+
+
+def _persist_rw_curr_results(cache_path, write_key=None, write_val=None, *, lock: Optional[LockSpec]):
+    if lock is None:
+        lock = LockSpec(cache_path)  # lock at call level
+    with FileLock(lock.path, timeout=lock.timeout, wait=lock.wait, tag=lock.tag):
+        res = _bucket.load_entries(cache_path)
         if write_key is not None:
             res[write_key] = write_val
-            _utils.to_pickle(res, cache_path)
+            _bucket.write_entries(cache_path, res)
         return res
 
 
-def _persist_write(cache_path, key, closure_func: Callable[[], Any], alt_dirs, *, lock_path):
-    need_to_run = True
+def _persist_lookup(cache_path, key, readonly=False, *, lock, client=None, lazy=False, value_store=None):
+    """Look up *key* in the bucket, through the cache server if there is one.
+
+    Returns (whether the key is found, cached value (or a `LazyValue` if *lazy*)).
+    """
+    entry = _get_pending_entry(cache_path, key)
+    if entry is None and client is not None:
+        from . import server
+        try:
+            _, entry = client.get_entry(cache_path, key, None if readonly else lock)
+        except server.ServerUnavailable as err:
+            server.mark_unavailable(client.address, err)
+            client = None
+    if entry is None and client is None:
+        if lazy:
+            # Buckets are replaced atomically, so the entry could be located without the lock
+            try:
+                handle = _lazy.LazyValue.from_bucket(cache_path, key, value_store)
+            except FileNotFoundError:
+                if readonly:
+                    raise
+                handle = None
+            if handle is not None and not handle.has_value():
+                print(f"Error: the value of {key} was removed from the value store. Treating it as a cache miss.")
+                handle = None
+            return handle is not None, handle
+        if readonly:
+            res = _bucket.read_entries(cache_path)[0]
+        else:
+            _print(
+                f"persist_to_disk: {cache_path} exists? : {os.path.isfile(cache_path)}.")
+            res = _persist_rw_curr_results(cache_path, lock=lock)
+        _print(
+            f"persist_to_disk: Looking up {key} in {cache_path}({res.keys()}): {key in res}.")
+        entry = res.get(key)
+    if entry is None:
+        return False, None
+    if lazy:
+        if not entry.has_value(value_store):
+            print(f"Error: the value of {key} was removed from the value store. Treating it as a cache miss.")
+            return False, None
+        return True, _lazy.LazyValue(entry, value_store)
+    try:
+        return True, entry.load(value_store)
+    except FileNotFoundError as err:
+        # The value in the value store was removed
+        print(f"Error: {err}. Treating it as a cache miss.")
+        return False, None
+
+
+def _persist_store(cache_path, key, val, meta=None, *, lock, client=None, value_store=None,
+                   serializer='auto'):
+    meta = meta or {}
+    entry = None
+    batch = _get_batch(cache_path)
+    if batch is not None:
+        entry = _bucket.encode_entry(val, value_store=value_store, serializer=serializer, **meta)
+        if batch.add(cache_path, key, entry, lock=lock):
+            return None
+        # The batch was flushed in the meantime: write directly
+    elif client is not None:
+        from . import server
+        try:
+            return client.put(cache_path, key, val, lock, meta=meta, value_store=value_store,
+                              serializer=serializer)
+        except server.ServerUnavailable as err:
+            server.mark_unavailable(client.address, err)
+    if entry is None:
+        entry = _bucket.encode_entry(val, value_store=value_store, serializer=serializer, **meta)
+    _persist_rw_curr_results(cache_path, key, entry, lock=lock)
+
+
+def _persist_write(cache_path, key, closure_func: Callable[[], Any], alt_dirs, *,
+                   lock, client=None, value_store=None, serializer='auto'):
+    need_to_run, meta = True, {}
     if alt_dirs is not None:
         assert isinstance(alt_dirs, list), f"alt_dirs should be a list, but got {alt_dirs}."
-        for temp_cache_path in alt_dirs:
+        for temp_cache_path, temp_value_store in alt_dirs:
             try:
-                val = _utils.read_pickle(temp_cache_path)[key]
+                val = _bucket.read_entries(temp_cache_path)[0][key].load(temp_value_store)
                 need_to_run = False
                 break
             except Exception as err:
                 print(f"Failed to read from {temp_cache_path}: {err}")
     if need_to_run:
+        start = time.time()
         val = closure_func()
+        meta['d'] = time.time() - start
     try:
-        _persist_rw_curr_results(cache_path, key, val, lock_path=lock_path)
+        _persist_store(cache_path, key, val, meta, lock=lock, client=client, value_store=value_store,
+                       serializer=serializer)
     except Timeout as err:
         raise err
     return val
 
 
+_inflight = {}  # calls being computed by a thread of this process
+_inflight_mutex = threading.Lock()
+
+
+def _reset_inflight():
+    """Forget the calls being computed (e.g. in a forked child, where their threads do not exist)."""
+    global _inflight, _inflight_mutex
+    _inflight, _inflight_mutex = {}, threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_inflight)
+
+
+def _persist_write_once(cache_path, key, closure_func: Callable[[], Any], alt_dirs, *,
+                        lock, client=None, value_store=None, serializer='auto'):
+    """Like _persist_write, but if another thread of this process is already computing the same call,
+    wait for it and read the result instead.
+    """
+    ident = (cache_path, _utils.dumps(key))
+    with _inflight_mutex:
+        event = _inflight.get(ident)
+        leader = event is None
+        if leader:
+            event = _inflight[ident] = threading.Event()
+    if leader:
+        try:
+            return _persist_write(cache_path, key, closure_func, alt_dirs,
+                                  lock=lock, client=client, value_store=value_store,
+                                  serializer=serializer)
+        finally:
+            with _inflight_mutex:
+                _inflight.pop(ident)
+            event.set()
+    event.wait()
+    found, val = _persist_lookup(cache_path, key, lock=lock, client=client, value_store=value_store)
+    if found:
+        return val
+    # The other thread failed
+    return _persist_write_once(cache_path, key, closure_func, alt_dirs,
+                               lock=lock, client=client, value_store=value_store,
+                               serializer=serializer)
+
+
+def _clear_buckets(cache_paths: List[str], predicate: Optional[Callable[[dict], bool]] = None, *,
+                   lock: LockSpec):
+    """Remove (the entries matching *predicate* from) buckets sharing the same lock.
+
+    Returns the number of bucket files modified or removed.
+    """
+    cnt = 0
+    with FileLock(lock.path, timeout=lock.timeout, wait=lock.wait, tag=lock.tag):
+        for cache_path in cache_paths:
+            if not os.path.isfile(cache_path):
+                continue
+            if predicate is None:
+                os.remove(cache_path)
+                cnt += 1
+                continue
+            res = _bucket.load_entries(cache_path)
+            kept = {k: v for k, v in res.items() if not predicate(dict(k))}
+            if len(kept) == len(res):
+                continue
+            if len(kept) > 0:
+                _bucket.write_entries(cache_path, kept)
+            else:
+                os.remove(cache_path)
+            cnt += 1
+    return cnt
+
+
+def _verify_buckets(cache_paths: List[str], repair=False, *, lock: LockSpec) -> Dict[str, int]:
+    """Check the buckets sharing the same lock, and salvage the corrupted ones if *repair*.
+
+    Returns {path: number of corrupted entries} for the corrupted buckets.
+    """
+    corrupted = {}
+    for cache_path in cache_paths:
+        try:
+            n_bad = _bucket.verify(cache_path)
+        except FileNotFoundError:
+            continue
+        if n_bad > 0:
+            corrupted[cache_path] = n_bad
+    if repair and len(corrupted) > 0:
+        with FileLock(lock.path, timeout=lock.timeout, wait=lock.wait, tag=lock.tag):
+            for cache_path in corrupted:
+                _bucket.load_entries(cache_path)
+    return corrupted
+
+
 def _persist_write_if_necessary(cache_path, key, closure_func: Callable[[], Any],
-                                readonly=False, alt_dirs=None, *, lock_path):
-    if readonly:
-        res = _utils.read_pickle(cache_path)
-        assert key in res, f"In readonly mode, but there is no existing cache {key}."
-        return res[key]
+                                readonly=False, alt_dirs=None, *, lock, client=None,
+                                fallback: Callable[[], Tuple[bool, Any]] = None, value_store=None, lazy=False,
+                                serializer='auto'):
     try:
-        _print(
-            f"persist_to_disk: {cache_path} exists? : {os.path.isfile(cache_path)}.")
-        res = _persist_rw_curr_results(cache_path, lock_path=lock_path)
-        _print(
-            f"persist_to_disk: Looking up {key} in {cache_path}({res.keys()}): {key in res}.")
-        if key in res:
-            return res[key]
+        found, val = _persist_lookup(cache_path, key, readonly, lock=lock, client=client, lazy=lazy,
+                                     value_store=value_store)
+        if found:
+            return val
     except Timeout as err:
         raise err
-    assert not readonly, "In readonly mode, but there is no existing cache."
-    return _persist_write(cache_path, key, closure_func, alt_dirs=alt_dirs, lock_path=lock_path)
+    if fallback is not None:
+        found, val = fallback()
+        if found:
+            return val
+    assert not readonly, f"In readonly mode, but there is no existing cache {key}."
+    return _persist_write_once(cache_path, key, closure_func, alt_dirs=alt_dirs,
+                               lock=lock, client=client, value_store=value_store,
+                               serializer=serializer)
+
+
+def _iter_bucket_files(cache_dir: str):
+    """All the buckets under *cache_dir* (skipping hidden directories like the value store)."""
+    for root, dirs, files in os.walk(cache_dir):
+        dirs[:] = sorted(_ for _ in dirs if not _.startswith('.'))
+        for name in sorted(files):
+            if name.endswith('.pkl'):
+                yield os.path.join(root, name)
+
+
+GC_GRACE_PERIOD = 600  # seconds. Newer values might be referenced by a write in progress.
+
+
+def _collect_garbage(cache_dir: str, value_store: str) -> int:
+    """Remove the values in *value_store* that are no longer referenced by any bucket under *cache_dir*.
+    Values stored (or re-used, see `_bucket.store_value`) within GC_GRACE_PERIOD are kept,
+    as writers only add their references to the buckets afterwards. So are the values of the
+    writes buffered in the WriteBatch's of this process, however old.
+
+    Returns the number of values removed.
+    """
+    # Before reading the buckets, so that writes flushed in the meantime are seen in either
+    with _active_batches_mutex:
+        batches = list(_active_batches)
+    refs = set().union(*[_.refs() for _ in batches])
+    for cache_path in _iter_bucket_files(cache_dir):
+        try:
+            refs.update(_.meta['ref'] for _ in _bucket.read_index(cache_path).values() if 'ref' in _.meta)
+        except FileNotFoundError:
+            continue
+    cnt, deadline = 0, time.time() - GC_GRACE_PERIOD
+    for path in glob.glob(os.path.join(glob.escape(value_store), '*', '*.pkl')):
+        if os.path.basename(path)[:-len('.pkl')] in refs:
+            continue
+        # Move it out of the way first, so that a writer re-using it in the meantime either
+        # refreshes its mtime (checked below) or does not find it (and writes it again).
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.gc"
+        try:
+            os.rename(path, tmp_path)
+        except FileNotFoundError:
+            continue
+        if os.stat(tmp_path).st_mtime > deadline:
+            os.replace(tmp_path, path)
+        else:
+            os.remove(tmp_path)
+            cnt += 1
+    return cnt
+
+
+def _prefetch_buckets(cache_paths: List[str], value_store: str = None, max_workers: int = None) -> int:
+    """Read the buckets (and the values they refer to in *value_store*) concurrently,
+    so that they are in the OS page cache when they are used.
+
+    Returns the number of buckets prefetched (missing ones are skipped).
+    """
+    def _prefetch(path):
+        try:
+            _bucket.prefetch(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        found = [path for path, ok in zip(cache_paths, pool.map(_prefetch, cache_paths)) if ok]
+        if value_store is not None:
+            refs = set()
+            for cache_path in found:
+                try:
+                    refs.update(_bucket.value_path(value_store, _.meta['ref'])
+                                for _ in _bucket.read_index(cache_path).values() if 'ref' in _.meta)
+                except FileNotFoundError:
+                    continue
+            list(pool.map(_prefetch, sorted(refs)))
+    return len(found)
+
+
+def export_cache(cache_dir: str, archive: str, header: dict = None) -> int:
+    """Stream all the buckets under *cache_dir* into a single archive.
+
+    Returns the number of entries exported.
+    """
+    cnt, value_store = 0, os.path.join(cache_dir, '.values')  # Values of *dedup* are copied into the archive
+    with _archive.ArchiveWriter(archive, header) as writer:
+        for cache_path in _iter_bucket_files(cache_dir):
+            entries, n_bad = _bucket.read_entries(cache_path)
+            if n_bad > 0:
+                print(f"Skipping {n_bad} corrupted entries in {cache_path}")
+            partition = os.path.relpath(os.path.dirname(cache_path), cache_dir)
+            for key, entry in entries.items():
+                writer.add(partition, key, entry.inline(value_store))
+                cnt += 1
+    return cnt
+
+
+def _merge_buckets(buckets: Dict[str, Dict[Any, Any]], read_entry: Callable[[Any], _bucket.Entry] = None,
+                   overwrite=True, value_store=None, *, lock: LockSpec) -> int:
+    """Write entries into buckets sharing the same lock, with one rewrite per bucket.
+    *buckets* maps each bucket to {key: entry (or anything *read_entry* turns into an entry)}.
+
+    Returns the number of entries written.
+    """
+    cnt = 0
+    with FileLock(lock.path, timeout=lock.timeout, wait=lock.wait, tag=lock.tag):
+        for cache_path, sources in buckets.items():
+            res = _bucket.load_entries(cache_path)
+            for key, source in sources.items():
+                if overwrite or key not in res:
+                    entry = source if read_entry is None else read_entry(source)
+                    res[key] = entry if value_store is None else _bucket.to_ref(entry, value_store)
+                    cnt += 1
+            _bucket.write_entries(cache_path, res)
+    return cnt
+
+
+def import_cache(archive: str, cache_dir: Optional[str], config: Config,
+                 hashsize: int = None, hash_method: str = None, lock_granularity: str = None,
+                 overwrite=False, max_workers: int = None, value_store: str = None,
+                 lock_timeout: float = None, lock_wait: str = None, tag: str = None) -> int:
+    """Merge the entries of an archive into the buckets under *cache_dir*, which are
+    resolved with *hashsize* and *hash_method* (defaulting to those of the exported function).
+    The locks are taken with *lock_timeout*, *lock_wait* and *tag* (see `_get_lock`).
+
+    Returns the number of entries imported.
+    """
+    groups = {}
+    with _archive.ArchiveReader(archive) as reader:
+        if cache_dir is None:
+            assert 'cache_dir' in reader.header, f"Please specify where to import {archive}."
+            cache_dir = os.path.join(config.get_project_persist_path(), reader.header['cache_dir'])
+        hashsize = hashsize or reader.header.get('hashsize') or config.get_hashsize()
+        hash_func = _HASH_FUNCS[hash_method or reader.header.get('hash_method', 'pickle')]
+        for partition, key, info in reader.entries():
+            cache_path = os.path.join(os.path.normpath(os.path.join(cache_dir, partition)),
+                                      f"{hash_func(key) % hashsize}.pkl")
+            lock = _get_lock(cache_path, config, lock_granularity, lock_timeout, lock_wait, tag)
+            groups.setdefault(lock, {}).setdefault(cache_path, {})[key] = info
+        for dirname in {os.path.dirname(_) for buckets in groups.values() for _ in buckets}:
+            os.makedirs(dirname, exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            futures = [pool.submit(_merge_buckets, buckets, reader.read, overwrite, value_store, lock=lock)
+                       for lock, buckets in groups.items()]
+            return sum(_.result() for _ in futures)
 
 
 # test input d={"model": {"1": {"2": 3, '2a': 4}}, 'a': 2}
@@ -194,29 +629,38 @@ def _clean_kwargs(full_kwargs, skip_kwargs, expand_dict_kwargs):
     return full_kwargs, special_kwargs
 
 
-def _get_hashed_path_and_key(cache_dir, full_kwargs, hashsize, groupby, hash_method):
+def _get_hashed_path_and_key(cache_dir, full_kwargs, hashsize, groupby, hash_method, make_if_necessary=True):
     for k in groupby:
         if isinstance(k, tuple):
             dirname = "$$".join([str(full_kwargs.pop(kk)) for kk in k])
         else:
             dirname = str(full_kwargs.pop(k))
         cache_dir = os.path.join(cache_dir, dirname)
-    _utils.make_dir_if_necessary(cache_dir)
+    if make_if_necessary:
+        _utils.make_dir_if_necessary(cache_dir)
     key = tuple(sorted(six.iteritems(full_kwargs), key=lambda x: x[0]))
-    hash_func = {'pickle': _hash, 'json': _hash_tuple_json}[hash_method]
-    hashed_path = os.path.join(cache_dir, f"{hash_func(key) % hashsize}.pkl")
+    hashed_path = os.path.join(cache_dir, f"{_HASH_FUNCS[hash_method](key) % hashsize}.pkl")
     return hashed_path, key
 
 
-def _get_lock_path(call_cache_path, config: Config, lock_granularity=None) -> str:
+def _get_lock(call_cache_path, config: Config, lock_granularity=None,
+              lock_timeout: float = None, lock_wait: str = None, tag: str = None) -> LockSpec:
+    """Resolve the lock of a bucket and how to wait for it (defaults to what's set in config).
+    Its wait metrics are recorded under *tag* (the cache directory of the function).
+    """
     if lock_granularity is None:
         lock_granularity = config.config['lock_granularity']
     if lock_granularity == 'call':
-        return call_cache_path
-    if lock_granularity == 'func':
-        return os.path.join(os.path.dirname(call_cache_path), 'func_persist_lock')
-    assert lock_granularity == 'global'
-    return os.path.join(config.get_project_persist_path(), 'global_persist_lock')
+        lock_path = call_cache_path
+    elif lock_granularity == 'func':
+        lock_path = os.path.join(os.path.dirname(call_cache_path), 'func_persist_lock')
+    else:
+        assert lock_granularity == 'global'
+        lock_path = os.path.join(config.get_project_persist_path(), 'global_persist_lock')
+    return LockSpec(lock_path,
+                    timeout=config.get_lock_timeout() if lock_timeout is None else lock_timeout,
+                    wait=config.get_lock_wait() if lock_wait is None else lock_wait,
+                    tag=tag)
 
 
 class Persister():
@@ -238,8 +682,10 @@ class Persister():
                  skip_kwargs: List[str] = None, expand_dict_kwargs: Union[List[str], str] = None,
                  groupby: List[str] = None,
                  switch_kwarg: str = 'cache_switch', cache: int = None, lock_granularity:str=None,
-                 hash_method='pickle', local=False, alt_dirs=None):
+                 hash_method='pickle', local=False, alt_dirs=None, adaptive=False, dedup=False,
+                 lazy=False, serializer='auto', lock_timeout: float = None, lock_wait: str = None):
         assert hash_method in {'pickle', 'json'}
+        assert serializer == 'auto' or _serializers.is_registered(serializer), f"Unknown serializer {serializer}."
         functools.update_wrapper(self, func)
         self.__defaults__ = six.get_function_defaults(func)
         if skip_kwargs is None:
@@ -269,6 +715,7 @@ class Persister():
         self.groupby = groupby
         self.lock_granularity = lock_granularity
         self.hash_method = hash_method
+        self.local = local
 
         # Get the cache_dir straight
         self.cache_dir = get_persist_dir_from_paths(
@@ -287,6 +734,88 @@ class Persister():
         self.cache = cache
         #print(local, self.cache_dir)
 
+        # Decide whether caching is worth it, basing on the measured compute/read time
+        self.policy = _adaptive.AdaptivePolicy() if adaptive else None
+
+        # Identical values are written once under their content hash
+        self.value_store = os.path.join(self.cache_dir, '.values') if dedup else None
+
+        # Return `LazyValue` handles that only deserialize the value on first access
+        self.lazy = lazy
+
+        # How to serialize the values (see `_serializers`)
+        self.serializer = serializer
+
+        # How to wait for the locks (defaults to what's set in config)
+        assert lock_wait is None or lock_wait in myfilelock.WAIT_STRATEGIES, f"Unknown lock_wait {lock_wait}."
+        self.lock_timeout = lock_timeout
+        self.lock_wait = lock_wait
+
+        # Archives read in place (see `import_cache`)
+        self.archives: List[_archive.ArchiveReader] = []
+
+    def _get_path_and_key(self, args, kwargs, make_if_necessary=True):
+        """Resolve the bucket path and the key of a call."""
+        full_kwargs = _get_full_kwargs_noargs(self.__wrapped__, args, kwargs)
+        _cleaned, special_kwargs = _clean_kwargs(
+            full_kwargs, self.skip_kwargs, self.expand_dict_kwargs)
+        return _get_hashed_path_and_key(
+            self.cache_dir, _cleaned, self.hashsize, self.groupby, self.hash_method,
+            make_if_necessary=make_if_necessary)
+
+    def _get_lock(self, hashed_path) -> LockSpec:
+        return _get_lock(hashed_path, self.config, self.lock_granularity,
+                         lock_timeout=self.lock_timeout, lock_wait=self.lock_wait, tag=self.cache_dir)
+
+    def _get_entry_info(self, args, kwargs) -> Optional[_bucket.EntryInfo]:
+        hashed_path, key = self._get_path_and_key(args, kwargs, make_if_necessary=False)
+        entry = _get_pending_entry(hashed_path, key)
+        if entry is not None:
+            return _bucket.EntryInfo(entry.meta, None, len(entry.data))
+        try:
+            info = _bucket.read_index(hashed_path).get(key)
+        except FileNotFoundError:
+            info = None
+        partition = os.path.relpath(os.path.dirname(hashed_path), self.cache_dir)
+        for reader in self.archives:
+            if info is not None:
+                break
+            info = reader.index.get((partition, key))
+        return info
+
+    def _get_partition_dirs(self, groupby_values: dict) -> List[str]:
+        """Find the existing partition directories matching (a subset of) the *groupby* values."""
+        groupby_values = dict(groupby_values)
+        parts = []
+        for k in self.groupby:
+            ks = k if isinstance(k, tuple) else (k,)
+            parts.append("$$".join([
+                glob.escape(str(groupby_values.pop(kk))) if kk in groupby_values else '*' for kk in ks]))
+        assert len(groupby_values) == 0, \
+            f"Expect only groupby kwargs {self.groupby}, but got {list(groupby_values.keys())}."
+        return [_ for _ in glob.glob(os.path.join(glob.escape(self.cache_dir), *parts)) if os.path.isdir(_)]
+
+    def _discard_pending(self, groupby_values: dict, predicate: Callable[[dict], bool] = None):
+        """Drop the writes to the selected partitions waiting in WriteBatch's."""
+        dirnames = self._get_partition_dirs(groupby_values)
+        with _active_batches_mutex:
+            batches = list(_active_batches)
+        for batch in batches:
+            batch.discard_dirs(dirnames, predicate)
+
+    def batch(self, max_workers: int = None) -> WriteBatch:
+        """Context manager to buffer the writes of this function, see `WriteBatch`."""
+        return WriteBatch(self.cache_dir, max_workers=max_workers)
+
+    def _get_buckets_by_lock(self, groupby_values: dict) -> Dict[LockSpec, List[str]]:
+        """Find the existing buckets in the selected partitions, grouped by their locks."""
+        groups = {}
+        for dirname in self._get_partition_dirs(groupby_values):
+            for cache_path in glob.glob(os.path.join(glob.escape(dirname), '*.pkl')):
+                lock = self._get_lock(cache_path)
+                groups.setdefault(lock, []).append(cache_path)
+        return groups
+
     def __call__(self, *args, **kwargs):
         kwargs = copy.deepcopy(kwargs)
         curr_cache_switch = int(kwargs.pop(self.switch_kwarg, CACHE))
@@ -294,32 +823,279 @@ class Persister():
         def closure():
             return self.__wrapped__(*args, **kwargs)
 
-        full_kwargs = _get_full_kwargs_noargs(self.__wrapped__, args, kwargs)
         cache_switch = self.cache if self.cache is not None else curr_cache_switch
         if cache_switch == NOCACHE:
-            return self.__wrapped__(**full_kwargs)
-        _cleaned, special_kwargs = _clean_kwargs(
-            full_kwargs, self.skip_kwargs, self.expand_dict_kwargs)
-        hashed_path, key = _get_hashed_path_and_key(
-            self.cache_dir, _cleaned, self.hashsize, self.groupby, self.hash_method)
-        lock_path = _get_lock_path(hashed_path, self.config, self.lock_granularity)
+            return self.__wrapped__(**_get_full_kwargs_noargs(self.__wrapped__, args, kwargs))
+        if cache_switch == CHECKONLY:
+            return self._get_entry_info(args, kwargs) is not None
+        hashed_path, key = self._get_path_and_key(args, kwargs)
+        lock = self._get_lock(hashed_path)
 
         alt_dirs = self.alt_dirs
         if alt_dirs is not None:
-            alt_dirs = [hashed_path.replace(self.cache_dir, _) for _ in alt_dirs]
+            # (bucket, value store) in each alternative directory
+            alt_dirs = [(hashed_path.replace(self.cache_dir, _), os.path.join(_, '.values')) for _ in alt_dirs]
+
+        fallback = None
+        if len(self.archives) > 0:
+            fallback = functools.partial(self._read_archives, hashed_path, key)
+
+        client = None
+        if self.config.get_server_address() is not None:
+            # Only imported when used, as it needs Unix sockets (not available on Windows)
+            from . import server
+            client = server.get_client(self.config.get_server_address())
+        if cache_switch == CACHE and self.policy is not None:
+            val = self._call_adaptive(hashed_path, key, closure, alt_dirs,
+                                      lock=lock, client=client, fallback=fallback)
+        elif cache_switch == RECACHE:
+            val = _persist_write(hashed_path, key, closure, alt_dirs=None,
+                                 lock=lock, client=client, value_store=self.value_store,
+                                 serializer=self.serializer)
+        else:
+            val = _persist_write_if_necessary(hashed_path, key, closure,
+                                              readonly=cache_switch == READONLY,
+                                              alt_dirs=alt_dirs, lock=lock, client=client,
+                                              fallback=fallback, value_store=self.value_store, lazy=self.lazy,
+                                              serializer=self.serializer)
+        if self.lazy and not isinstance(val, _lazy.LazyValue):
+            val = _lazy.LazyValue.from_value(val)
+        return val
+
+    def _call_adaptive(self, hashed_path, key, closure, alt_dirs, *, lock, client=None, fallback=None):
+        """Same as CACHE mode, but skips the disk if self.policy decides so.
+        Only cache hits are timed as reads (with *lazy*, that only covers locating the entry).
+        """
+        policy = self.policy
 
-        if cache_switch == RECACHE:
-            return _persist_write(hashed_path, key, closure, alt_dirs=None, lock_path=lock_path)
-        return _persist_write_if_necessary(hashed_path, key, closure,
-                                           readonly=cache_switch == READONLY,
-                                           alt_dirs=alt_dirs, lock_path=lock_path)
+        def timed_closure():
+            start = time.time()
+            val = closure()
+            policy.record_compute(time.time() - start, val)
+            return val
 
-    def clear(self):
-        """clean all the cache for self.__wrapped__
+        if policy.decision == _adaptive.PERSIST:
+            start = time.time()
+            found, val = _persist_lookup(hashed_path, key, lock=lock, client=client,
+                                         lazy=self.lazy, value_store=self.value_store)
+            if found:
+                policy.record_read(time.time() - start)
+            elif fallback is not None:
+                found, val = fallback()
+            if found:
+                return val
+            return _persist_write_once(hashed_path, key, timed_closure, alt_dirs=alt_dirs,
+                                       lock=lock, client=client, value_store=self.value_store,
+                                       serializer=self.serializer)
+        memory_key = _utils.dumps((hashed_path, key))
+        if policy.decision == _adaptive.MEMORY:
+            found, val = policy.memory_get(memory_key)
+            if found:
+                return val
+        val = timed_closure()
+        if policy.decision == _adaptive.MEMORY:
+            policy.memory_put(memory_key, val)
+        return val
+
+    def _read_archives(self, hashed_path, key) -> Tuple[bool, Any]:
+        partition = os.path.relpath(os.path.dirname(hashed_path), self.cache_dir)
+        for reader in self.archives:
+            found, val = reader.get(partition, key)
+            if found:
+                return found, val
+        return False, None
+
+    def export_cache(self, archive: str) -> int:
+        """Pack the cache of self.__wrapped__ into a single archive file.
+
+        Returns:
+            int: number of entries exported.
+        """
+        header = {'name': self.__name__,
+                  'cache_dir': os.path.relpath(self.cache_dir, self.config.get_project_persist_path(local=self.local)),
+                  'hashsize': self.hashsize, 'hash_method': self.hash_method}
+        return export_cache(self.cache_dir, archive, header)
+
+    def import_cache(self, archive: str, in_place=False, overwrite=False, max_workers: int = None) -> int:
+        """Merge the entries of an archive (made by `export_cache`) into the cache of self.__wrapped__.
+
+        Args:
+            archive (str): path to the archive.
+            in_place (bool, optional):
+                Instead of copying the entries, read them from the archive (on cache misses).
+                Defaults to False.
+            overwrite (bool, optional):
+                Overwrite the existing entries with those in the archive. Defaults to False.
+            max_workers (int, optional):
+                Number of threads to write the buckets. Defaults to None.
+
+        Returns:
+            int: number of entries imported (or available in the archive, if *in_place*).
+        """
+        if in_place:
+            self.archives.append(_archive.ArchiveReader(archive))
+            return len(self.archives[-1])
+        return import_cache(archive, self.cache_dir, self.config, self.hashsize, self.hash_method,
+                            self.lock_granularity, overwrite=overwrite, max_workers=max_workers,
+                            value_store=self.value_store, lock_timeout=self.lock_timeout, lock_wait=self.lock_wait,
+                            tag=self.cache_dir)
+
+    def adaptive_report(self) -> Optional[dict]:
+        """Measured compute/read time and value size, and the current (and past) decisions
+        of the adaptive policy: 'persist', 'memory' (keep results in memory only) or 'skip'.
+        None if the function is not *adaptive*.
+        """
+        if self.policy is None:
+            return None
+        return self.policy.report()
+
+    def lock_stats(self) -> dict:
+        """Lock-wait metrics of this process for the locks taken by this function
+        (even if shared with other functions): number of acquisitions (and of those that had to wait),
+        total and max wait time (in seconds) and number of timeouts.
+        """
+        res = {'n_acquired': 0, 'n_contended': 0, 'wait_time': 0., 'max_wait_time': 0., 'n_timeouts': 0}
+        for (_, tag), stats in myfilelock.lock_manager.stats().items():
+            if tag != self.cache_dir:
+                continue
+            for k, v in stats.items():
+                res[k] = max(res[k], v) if k == 'max_wait_time' else res[k] + v
+        return res
+
+    def prefetch(self, calls: List[dict], max_workers: int = None) -> int:
+        """Load the buckets of the given calls into the OS page cache, concurrently.
+        Useful before a loop over these calls, especially on network file systems.
+
+        Args:
+            calls (List[dict]):
+                kwargs of each call, e.g. `[{'a': 1}, {'a': 2}]`.
+                All the arguments without defaults must be given (TypeError otherwise).
+            max_workers (int, optional):
+                Number of threads to read the buckets. Defaults to None.
+
+        Returns:
+            int: number of buckets prefetched (buckets that do not exist yet are skipped).
+        """
+        signature = inspect.signature(self.__wrapped__)
+        cache_paths = set()
+        for kwargs in calls:
+            kwargs = {k: v for k, v in kwargs.items() if k != self.switch_kwarg}
+            signature.bind(**kwargs)  # Incomplete calls would be hashed into the wrong buckets
+            cache_paths.add(self._get_path_and_key((), kwargs, make_if_necessary=False)[0])
+        return _prefetch_buckets(sorted(cache_paths), self.value_store, max_workers=max_workers)
+
+    def warmup(self, max_workers: int = None, **groupby_values) -> int:
+        """Same as `prefetch`, but for all the buckets of the selected partitions.
+
+        Args:
+            max_workers (int, optional):
+                Number of threads to read the buckets. Defaults to None.
+            **groupby_values:
+                Values of the *groupby* kwargs to select the partitions.
+                Defaults to all partitions.
+
+        Returns:
+            int: number of buckets prefetched.
         """
-        files = glob.glob(f'{self.cache_dir}/*')
-        for f in files:
-            os.remove(f)
+        cache_paths = [_ for paths in self._get_buckets_by_lock(groupby_values).values() for _ in paths]
+        return _prefetch_buckets(sorted(cache_paths), self.value_store, max_workers=max_workers)
+
+    def clear(self, predicate: Callable[[dict], bool] = None, max_workers: int = None, **groupby_values) -> int:
+        """Clear the cache for self.__wrapped__, or only part of it.
+        Buckets are processed in parallel, each while holding its lock.
+        With *dedup*, values that are no longer referenced (and were not used within GC_GRACE_PERIOD)
+        are removed as well.
+
+        Args:
+            predicate (Callable[[dict], bool], optional):
+                If given, only remove entries whose key (as a dict of the cleaned kwargs,
+                excluding *groupby* ones) satisfies it.
+                Defaults to None (remove everything in the selected partitions).
+            max_workers (int, optional):
+                Number of threads to process the buckets. Defaults to None.
+            **groupby_values:
+                Values of the *groupby* kwargs to select the partitions to clear.
+                For example, `f.clear(dataset='MNIST')`.
+                Defaults to all partitions.
+
+        Returns:
+            int: number of bucket files modified or removed.
+        """
+        if self.policy is not None:
+            self.policy.memory_clear()
+        self._discard_pending(groupby_values, predicate)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            futures = [pool.submit(_clear_buckets, cache_paths, predicate, lock=lock)
+                       for lock, cache_paths in self._get_buckets_by_lock(groupby_values).items()]
+            cnt = sum(_.result() for _ in futures)
+        if self.value_store is not None:
+            _collect_garbage(self.cache_dir, self.value_store)
+        return cnt
+
+    def verify(self, repair: bool = False, max_workers: int = None, **groupby_values) -> Dict[str, int]:
+        """Check the checksums of the cache for self.__wrapped__, without unpickling any value.
+
+        Args:
+            repair (bool, optional):
+                Rewrite the corrupted buckets with the intact entries
+                (the originals are kept as *.corrupted*). Defaults to False.
+            max_workers (int, optional):
+                Number of threads to process the buckets. Defaults to None.
+            **groupby_values:
+                Values of the *groupby* kwargs to select the partitions to verify.
+                Defaults to all partitions.
+
+        Returns:
+            Dict[str, int]: number of corrupted entries for each corrupted bucket.
+        """
+        res = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            futures = [pool.submit(_verify_buckets, cache_paths, repair, lock=lock)
+                       for lock, cache_paths in self._get_buckets_by_lock(groupby_values).items()]
+            for future in futures:
+                res.update(future.result())
+        return res
+
+    def contains(self, *args, **kwargs) -> bool:
+        """Whether the call is cached. Only the keys in the bucket are read, not the values.
+        """
+        kwargs = copy.deepcopy(kwargs)
+        kwargs.pop(self.switch_kwarg, None)
+        return self._get_entry_info(args, kwargs) is not None
+
+    def peek_meta(self, *args, **kwargs) -> Optional[dict]:
+        """Meta data of the cached call, without reading the value.
+
+        Returns:
+            Optional[dict]: None if the call is not cached. Otherwise,
+                size (bytes of the pickled value), written_at (timestamp, None if unknown) and
+                duration (seconds to compute the value, None if unknown).
+        """
+        kwargs = copy.deepcopy(kwargs)
+        kwargs.pop(self.switch_kwarg, None)
+        info = self._get_entry_info(args, kwargs)
+        if info is None:
+            return None
+        return {'size': info.meta.get('s', info.size), 'written_at': info.meta.get('t'), 'duration': info.meta.get('d')}
+
+    def invalidate(self, *args, **kwargs) -> bool:
+        """Remove the cache of one call, specified by the exact same arguments.
+
+        Returns:
+            bool: whether there was a cache to remove.
+        """
+        kwargs = copy.deepcopy(kwargs)
+        kwargs.pop(self.switch_kwarg, None)
+        hashed_path, key = self._get_path_and_key(args, kwargs, make_if_necessary=False)
+        if self.policy is not None:
+            self.policy.memory_clear()
+        with _active_batches_mutex:
+            batches = list(_active_batches)
+        for batch in batches:
+            batch.discard(hashed_path, lambda k: k == dict(key))
+        if not os.path.isfile(hashed_path):
+            return False
+        return _clear_buckets([hashed_path], lambda k: k == dict(key), lock=self._get_lock(hashed_path)) > 0
 
 
 # function version =====================
@@ -331,6 +1107,17 @@ def persist_func_version(func, config: Config, **kwargs):
     @functools.wraps(func)
     def inner(*args, **kwargs):
         return obj(*args, **kwargs)
+    inner.clear = obj.clear
+    inner.invalidate = obj.invalidate
+    inner.verify = obj.verify
+    inner.contains = obj.contains
+    inner.peek_meta = obj.peek_meta
+    inner.adaptive_report = obj.adaptive_report
+    inner.batch = obj.batch
+    inner.prefetch = obj.prefetch
+    inner.warmup = obj.warmup
+    inner.lock_stats = obj.lock_stats
+    inner.persister = obj
     return inner
 
 # ===========================Manual Cache
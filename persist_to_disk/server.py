@@ -0,0 +1,330 @@
+"""Optional local cache server.
+
+The server owns the on-disk store of the persisted functions and keeps hot buckets in memory,
+so that many worker processes on the same node do not each lock and unpickle the same buckets.
+Workers talk to it over a Unix domain socket, and `Persister` uses it transparently once
+`config.set_server_address` is called (falling back to direct file access if it is unreachable).
+
+Start it with
+```
+python -m persist_to_disk.server --address /tmp/ptd.sock
+```
+
+WARNING: Messages are pickled, so only run the server for a socket that only you can access.
+"""
+import argparse
+import collections
+import os
+import pickle
+import socket
+import socketserver
+import struct
+import threading
+import time
+from typing import Any, List, Optional, Tuple
+
+from . import _bucket
+from .myfilelock import FileLock, LockSpec
+
+_HEADER = struct.Struct('!Q')
+RETRY_INTERVAL = 30  # seconds to wait before re-connecting to an unreachable server
+
+
+class ServerUnavailable(ConnectionError):
+    """The cache server could not be reached."""
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(min(size - len(buf), 1 << 20))
+        if not chunk:
+            raise ConnectionResetError("Connection closed by peer.")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def _send_msg(sock: socket.socket, obj):
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_msg(sock: socket.socket):
+    size, = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    return pickle.loads(_recv_exact(sock, size))
+
+
+def _stat_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _portable_error(err: Exception) -> Exception:
+    """Make sure the exception can be sent back to the client."""
+    try:
+        pickle.loads(pickle.dumps(err))
+        return err
+    except Exception:  # pylint: disable=broad-except
+        return RuntimeError(f"{type(err).__name__}: {err}")
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.server.add_connection(self.request)
+
+    def finish(self):
+        self.server.remove_connection(self.request)
+
+    def handle(self):
+        while True:
+            try:
+                op, args = _recv_msg(self.request)
+            except (ConnectionError, EOFError):
+                return
+            try:
+                resp = (True, self.server.cache.handle(op, args))
+            except Exception as err:  # pylint: disable=broad-except
+                resp = (False, _portable_error(err))
+            _send_msg(self.request, resp)
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._connections = set()
+        self._connections_mutex = threading.Lock()
+
+    def add_connection(self, sock: socket.socket):
+        with self._connections_mutex:
+            self._connections.add(sock)
+
+    def remove_connection(self, sock: socket.socket):
+        with self._connections_mutex:
+            self._connections.discard(sock)
+
+    def close_connections(self):
+        """Disconnect the clients, so that the handler threads stop serving them."""
+        with self._connections_mutex:
+            connections, self._connections = list(self._connections), set()
+        for sock in connections:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class CacheServer:
+    """Serves get/put/contains/batch requests for buckets, keeping hot buckets in memory.
+
+    Writes go through to disk (with the usual file locks), and buckets in memory are re-read
+    if the file was changed by a process that does not use the server.
+    """
+
+    def __init__(self, address: str, max_buckets: int = 256) -> None:
+        self.address = address
+        self.max_buckets = max_buckets
+        self._buckets = collections.OrderedDict()  # cache_path -> (stat signature, dict)
+        self._mutex = threading.Lock()
+        self.stats = {'hits': 0, 'loads': 0, 'writes': 0}
+        self._server = None
+        self._thread = None
+
+    # In-memory buckets ==================
+    def _remember(self, cache_path, res):
+        with self._mutex:
+            self._buckets[cache_path] = (_stat_signature(cache_path), res)
+            self._buckets.move_to_end(cache_path)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+
+    def _load(self, cache_path, lock: LockSpec = None):
+        sig = _stat_signature(cache_path)
+        with self._mutex:
+            entry = self._buckets.get(cache_path)
+            if entry is not None and sig is not None and entry[0] == sig:
+                self._buckets.move_to_end(cache_path)
+                self.stats['hits'] += 1
+                return entry[1]
+        self.stats['loads'] += 1
+        if lock is None:
+            # readonly
+            return {} if sig is None else _bucket.read_entries(cache_path)[0]
+        with FileLock(lock.path, timeout=lock.timeout, wait=lock.wait, tag=lock.tag):
+            res = _bucket.load_entries(cache_path)
+            self._remember(cache_path, res)
+        return res
+
+    # Operations ==================
+    def get(self, cache_path, key, lock: LockSpec = None) -> Tuple[bool, Optional[_bucket.Entry]]:
+        """Returns (whether *key* is found, the still-pickled entry)."""
+        res = self._load(cache_path, lock)
+        return key in res, res.get(key)
+
+    def contains(self, cache_path, key, lock: LockSpec = None) -> bool:
+        return key in self._load(cache_path, lock)
+
+    def put(self, cache_path, key, entry: _bucket.Entry, lock: LockSpec):
+        with FileLock(lock.path, timeout=lock.timeout, wait=lock.wait, tag=lock.tag):
+            res = dict(_bucket.load_entries(cache_path))
+            res[key] = entry
+            _bucket.write_entries(cache_path, res)
+            self._remember(cache_path, res)
+        self.stats['writes'] += 1
+
+    def batch(self, requests: List[Tuple[str, tuple]]) -> List[Tuple[bool, Any]]:
+        resps = []
+        for op, args in requests:
+            try:
+                resps.append((True, self.handle(op, args)))
+            except Exception as err:  # pylint: disable=broad-except
+                resps.append((False, _portable_error(err)))
+        return resps
+
+    def handle(self, op: str, args: tuple):
+        assert op in {'get', 'contains', 'put', 'batch', 'ping', 'get_stats'}, f"Unknown operation {op}."
+        if op == 'ping':
+            return True
+        if op == 'get_stats':
+            return dict(self.stats, buckets=len(self._buckets))
+        return getattr(self, op)(*args)
+
+    # Lifecycle ==================
+    def _make_server(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        server = _UnixServer(self.address, _RequestHandler)
+        os.chmod(self.address, 0o600)
+        server.cache = self
+        return server
+
+    def serve_forever(self):
+        self._server = server = self._make_server()
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            server.close_connections()
+
+    def start(self):
+        """Serve in a background thread."""
+        self._server = self._make_server()
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server.close_connections()
+            self._server = None
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args, **kwargs):
+        self.shutdown()
+
+
+class CacheClient:
+    """Client of `CacheServer`. One connection, not to be shared across threads/processes.
+    """
+
+    def __init__(self, address: str, timeout: Optional[float] = None) -> None:
+        self.address = address
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(address)
+        except OSError as err:
+            self.sock.close()
+            raise ServerUnavailable(f"Cannot connect to the cache server at {address}: {err}") from err
+
+    def _request(self, op, *args):
+        try:
+            _send_msg(self.sock, (op, args))
+            ok, resp = _recv_msg(self.sock)
+        except OSError as err:
+            self.close()
+            raise ServerUnavailable(f"Lost connection to the cache server at {self.address}: {err}") from err
+        if not ok:
+            raise resp
+        return resp
+
+    def get_entry(self, cache_path, key, lock: LockSpec = None) -> Tuple[bool, Optional[_bucket.Entry]]:
+        return self._request('get', cache_path, key, lock)
+
+    def get(self, cache_path, key, lock: LockSpec = None, value_store: str = None) -> Tuple[bool, Any]:
+        found, entry = self.get_entry(cache_path, key, lock)
+        return (True, entry.load(value_store)) if found else (False, None)
+
+    def contains(self, cache_path, key, lock: LockSpec = None) -> bool:
+        return self._request('contains', cache_path, key, lock)
+
+    def put(self, cache_path, key, val, lock: LockSpec, meta: dict = None, value_store: str = None,
+            serializer: str = 'auto'):
+        entry = _bucket.encode_entry(val, value_store=value_store, serializer=serializer, **(meta or {}))
+        return self._request('put', cache_path, key, entry, lock)
+
+    def batch(self, requests: List[Tuple[str, tuple]]) -> List[Tuple[bool, Any]]:
+        """Each request is (op, args). Returns a list of (success, result or exception).
+        Note that values are sent and received as `_bucket.Entry`.
+        """
+        return self._request('batch', requests)
+
+    def ping(self):
+        return self._request('ping')
+
+    def get_stats(self):
+        return self._request('get_stats')
+
+    def close(self):
+        self.sock.close()
+
+
+_clients = threading.local()
+_unavailable_until = {}
+
+
+def get_client(address: Optional[str]) -> Optional[CacheClient]:
+    """Get the client of this thread (and process) for the server at *address*.
+    Returns None if *address* is None or the server was recently unreachable.
+    """
+    if address is None or _unavailable_until.get(address, 0) > time.time():
+        return None
+    if getattr(_clients, 'pid', None) != os.getpid():
+        _clients.pid, _clients.clients = os.getpid(), {}
+    client = _clients.clients.get(address)
+    if client is None or client.sock.fileno() == -1:
+        try:
+            client = _clients.clients[address] = CacheClient(address)
+        except ServerUnavailable as err:
+            mark_unavailable(address, err)
+            return None
+    return client
+
+
+def mark_unavailable(address: str, err: Exception = None):
+    """Skip the server at *address* for RETRY_INTERVAL seconds."""
+    print(f"{err}. Using direct file access for {RETRY_INTERVAL} seconds.")
+    _unavailable_until[address] = time.time() + RETRY_INTERVAL
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local cache server for persist_to_disk.")
+    parser.add_argument('--address', required=True, help="Path of the Unix domain socket.")
+    parser.add_argument('--max-buckets', type=int, default=256, help="Number of buckets kept in memory.")
+    args = parser.parse_args()
+    print(f"Serving persist_to_disk cache at {args.address}")
+    CacheServer(args.address, max_buckets=args.max_buckets).serve_forever()
+
+
+if __name__ == '__main__':
+    main()